@@ -5,8 +5,7 @@ from __future__ import print_function
 import data
 
 import numpy as np
-import tensorflow as tf
-from toxicity_classifier import ToxicityClassifier
+from toxicity_classifier import ToxicityClassifier, create_session
 from agents.smart_replace import smart_replace, get_possible_replace
 from attacks.hot_flip import HotFlip
 import time
@@ -23,7 +22,7 @@ def check_num_of_flips(best_flip_status):
 def main():
 
     # get restore model
-    sess = tf.Session()
+    sess = create_session()
     tox_model = ToxicityClassifier(session=sess)
 
     hot_flip = HotFlip(model=tox_model,break_on_half = True,beam_search_size = 10)
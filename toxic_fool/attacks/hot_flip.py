@@ -5,8 +5,7 @@ from __future__ import print_function
 import data
 
 import numpy as np
-import tensorflow as tf
-from toxicity_classifier import ToxicityClassifier
+from toxicity_classifier import ToxicityClassifier, create_session
 #from agents.smart_replace import get_possible_replace
 
 SMALL_LETTERS = 'qwertyuiopasdfghjklzxcvbnm'
@@ -337,7 +336,7 @@ def check_length(dataset):
 def example():
 
     # get restore model
-    sess = tf.Session()
+    sess = create_session()
     tox_model = ToxicityClassifier(session=sess)
 
     hot_flip = HotFlip(model=tox_model)
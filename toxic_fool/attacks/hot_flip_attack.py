@@ -6,8 +6,7 @@ from os import path
 import data
 import glob
 import numpy as np
-import tensorflow as tf
-from toxicity_classifier import ToxicityClassifier
+from toxicity_classifier import ToxicityClassifier, create_session
 from attacks.hot_flip import HotFlip
 import time
 import resources as out
@@ -131,7 +130,7 @@ class HotFlipAttack(object):
 
 def example():
     # get restore model
-    sess = tf.Session()
+    sess = create_session()
     tox_model = ToxicityClassifier(session=sess)
 
     #create hot flip attack, and attack
@@ -6,6 +6,7 @@ from keras.preprocessing import text, sequence
 import pandas as pd
 import numpy as np
 import re
+import functools
 import unicodedata
 from os import path
 
@@ -40,6 +41,7 @@ class Dataset(object):
         self.test_replace_lbl = test_replace_lbl
 
     @classmethod
+    @functools.lru_cache(maxsize=1)
     def init_embedding_from_dump(cls):
         return np.load(path.join(out.RES_OUT_DIR, CHAR_EMBEDDING_TEST_DUMP)), \
                np.load(path.join(out.RES_OUT_DIR, CHAR_INDEX_TEST_DUMP)).item(), \
@@ -3,4 +3,4 @@ from __future__ import division
 from __future__ import print_function
 
 from .metrics import calc_precision, calc_recall, calc_f1, RocCallback
-from .classifier import ToxClassifierConfig, ToxicityClassifier
+from .classifier import ToxClassifierConfig, ToxicityClassifier, create_session
@@ -4,12 +4,14 @@ from __future__ import print_function
 
 import numpy as np
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 import keras
 from keras import backend as K
 from keras import layers
 from keras.engine import InputSpec, Layer
 from keras import initializers
 from keras.callbacks import ModelCheckpoint
+from keras.utils import Sequence
 import os
 from os import path
 
@@ -23,12 +25,14 @@ class AttentionWeightedAverage(Layer):
     """
     Computes a weighted average of the different channels across timesteps.
     Uses 1 parameter pr. channel to compute the attention value for a single timestep.
+    With return_pooling the max and average over timesteps are computed in the same pass.
     """
 
-    def __init__(self, return_attention=False, **kwargs):
+    def __init__(self, return_attention=False, return_pooling=False, **kwargs):
         self.init = initializers.get('uniform')
         self.supports_masking = True
         self.return_attention = return_attention
+        self.return_pooling = return_pooling
         super(AttentionWeightedAverage, self).__init__(**kwargs)
 
     def build(self, input_shape):
@@ -39,62 +43,161 @@ class AttentionWeightedAverage(Layer):
                                              name='{}_atten_weights'.format(self.name),
                                              initializer=self.init)
         self.trainable_weights = [self.atten_weights]
+        self._eps = K.constant(K.epsilon(), dtype=K.floatx())
         super(AttentionWeightedAverage, self).build(input_shape)
 
     def call(self, inputs, **kwargs):
         # computes a probability distribution over the timesteps
         # uses 'max trick' for numerical stability
-        # reshape is done to avoid issue with Tensorflow
-        # and 1-dimensional weights
+        # the softmax max and sum reduce the small (batch, timesteps) logits only,
+        # and the weighted sums are taken with a matmul instead of a materialized inputs * weights product
         mask = None
         for key, value in kwargs.items():
             if key == "mask":
                 mask = value
 
-        logits = K.dot(inputs, self.atten_weights)
-        x_shape = K.shape(inputs)
-        logits = K.reshape(logits, (x_shape[0], x_shape[1]))
+        logits = tf.squeeze(K.dot(inputs, self.atten_weights), axis=-1)
         ai = K.exp(logits - K.max(logits, axis=-1, keepdims=True))
 
         # masked timesteps have zero weight
         if mask is not None:
-            mask = K.cast(mask, K.floatx())
+            if K.dtype(mask) != K.dtype(ai):
+                mask = K.cast(mask, K.dtype(ai))
             ai = ai * mask
-        att_weights = ai / (K.sum(ai, axis=1, keepdims=True) + K.epsilon())
-        weighted_input = inputs * K.expand_dims(att_weights)
-        result = K.sum(weighted_input, axis=1)
-        return [result, att_weights]
+        att_weights = ai / (K.sum(ai, axis=1, keepdims=True) + self._eps)
+        if not self.return_pooling:
+            # (batch, 1, timesteps) x (batch, timesteps, channels) -> (batch, channels)
+            result = tf.squeeze(tf.matmul(K.expand_dims(att_weights, axis=1), inputs), axis=1)
+            return [result, att_weights]
+
+        # the average is just another weighting of the timesteps, stack it with the attention
+        # weights so both sums come out of one matmul over the inputs
+        if mask is not None:
+            mean_weights = mask / (K.sum(mask, axis=1, keepdims=True) + self._eps)
+        else:
+            mean_weights = K.ones_like(logits) / K.cast(K.shape(inputs)[1], K.floatx())
+        all_weights = K.stack([att_weights, mean_weights], axis=1)
+        # (batch, 2, timesteps) x (batch, timesteps, channels) -> (batch, 2, channels)
+        weighted_sums = tf.matmul(all_weights, inputs)
+        result = weighted_sums[:, 0]
+        avg = weighted_sums[:, 1]
+        max_pool = K.max(inputs, axis=1)
+        return [result, max_pool, avg, att_weights]
 
     def get_output_shape(self, input_shape):
         return self.compute_output_shape(input_shape)
 
     def compute_output_shape(self, input_shape):
         output_len = input_shape[2]
+        if self.return_pooling:
+            # [atten_weighted_sum, max_pool, avg_pool, atten_weights]
+            return [(input_shape[0], output_len)] * 3 + [(input_shape[0], input_shape[1])]
         return [(input_shape[0], output_len), (input_shape[0], input_shape[1])]  # [atten_weighted_sum, atten_weights]
 
+    def compute_mask(self, inputs, mask=None):
+        return [None, None, None, None] if self.return_pooling else [None, None]
+
+
+class BatchSequence(Sequence):
+    """
+    Serves (seq, lbl) batches to fit_generator, reshuffling at the end of every epoch when shuffle is set.
+    """
+
+    def __init__(self, seq, lbl, batch_size=500, shuffle=True):
+        self._seq = seq
+        self._lbl = lbl
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._indices = np.random.permutation(len(seq)) if shuffle else np.arange(len(seq))
+
+    def __len__(self):
+        return int(np.ceil(len(self._seq) / float(self._batch_size)))
+
+    def __getitem__(self, idx):
+        batch_idx = np.sort(self._indices[idx * self._batch_size:(idx + 1) * self._batch_size])
+        return self._seq[batch_idx], self._lbl[batch_idx]
+
+    def on_epoch_end(self):
+        if self._shuffle:
+            np.random.shuffle(self._indices)
+
+
+class LossScaledAdam(keras.optimizers.Adam):
+    """
+    Adam for a loss multiplied by a static loss_scale (see CustomLoss): the gradients are divided back
+    before clipping, so small float16 gradients don't underflow to zero under mixed precision.
+    """
+
+    def __init__(self, loss_scale=128., **kwargs):
+        self.loss_scale = loss_scale
+        super(LossScaledAdam, self).__init__(**kwargs)
+
+    def get_gradients(self, loss, params):
+        grads = K.gradients(loss, params)
+        if None in grads:
+            raise ValueError('An operation has `None` for gradient. '
+                             'Please make sure that all of your ops have a '
+                             'gradient defined (i.e. are differentiable). '
+                             'Common ops without gradient: '
+                             'K.argmax, K.round, K.eval.')
+        grads = [g / self.loss_scale for g in grads]
+        if hasattr(self, 'clipnorm') and self.clipnorm > 0:
+            norm = K.sqrt(sum([K.sum(K.square(g)) for g in grads]))
+            grads = [keras.optimizers.clip_norm(g, self.clipnorm, norm) for g in grads]
+        if hasattr(self, 'clipvalue') and self.clipvalue > 0:
+            grads = [K.clip(g, -self.clipvalue, self.clipvalue) for g in grads]
+        return grads
+
 
 class CustomLoss(object):
     @staticmethod
-    def binary_crossentropy_with_bias(train_labels_1_ratio, train_on_toxic_only=False):
+    def binary_crossentropy_with_bias(train_labels_1_ratio, train_on_toxic_only=False, loss_scale=1.):
         train_labels_0_ratio = 1 - train_labels_1_ratio
         train_labels_1_bias = 1 / train_labels_1_ratio
         train_labels_0_bias = 1 / train_labels_0_ratio
         train_labels_normalizer = train_labels_0_bias * train_labels_1_bias
         train_labels_0_bias = train_labels_0_bias / train_labels_normalizer
         train_labels_1_bias = train_labels_1_bias / train_labels_normalizer
+        if train_on_toxic_only:
+            train_labels_0_bias = train_labels_0_bias[0]
+            train_labels_1_bias = train_labels_1_bias[0]
+        # bce(1 - y, 1 - p) == bce(y, p), so the bias_1 and bias_0 terms add up to one weighted crossentropy
+        train_labels_bias = K.constant(train_labels_0_bias + train_labels_1_bias, dtype='float32')
 
         def loss_function(y_true, y_pred):
+            # keep the loss in float32 even when the graph runs in mixed precision
+            y_true = K.cast(y_true, 'float32')
+            y_pred = K.cast(y_pred, 'float32')
             if train_on_toxic_only:
-                return K.mean(train_labels_1_bias[0] * K.binary_crossentropy(y_true[:, 0], y_pred[:, 0]),
-                              axis=-1) + K.mean(
-                    train_labels_0_bias[0] * K.binary_crossentropy(1 - y_true[:, 0], 1 - y_pred[:, 0]), axis=-1)
-            else:
-                return K.mean(train_labels_1_bias * K.binary_crossentropy(y_true, y_pred), axis=-1) + K.mean(
-                    train_labels_0_bias * K.binary_crossentropy(1 - y_true, 1 - y_pred), axis=-1)
+                y_true = y_true[:, 0]
+                y_pred = y_pred[:, 0]
+            # loss_scale > 1 only with LossScaledAdam, which divides the gradients back
+            return loss_scale * K.mean(train_labels_bias * K.binary_crossentropy(y_true, y_pred), axis=-1)
 
         return loss_function
 
 
+def create_session(xla_jit=True, mixed_precision=False):
+    # type: (bool, bool) -> tf.Session
+    config = tf.ConfigProto()
+    if xla_jit:
+        # let XLA auto-cluster the many small elementwise/reduction kernels of the model
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    if mixed_precision:
+        # grappler runs matmuls / rnns in float16 on tensor cores and keeps exp, log and reductions in float32
+        config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+    return tf.Session(config=config)
+
+
+def uses_mixed_precision(session):
+    # type: (tf.Session) -> bool
+    # the session decides whether the float16 rewrite runs, so it is the one place to read it from
+    config = getattr(session, '_config', None)
+    if config is None:
+        return False
+    return config.graph_options.rewrite_options.auto_mixed_precision == rewriter_config_pb2.RewriterConfig.ON
+
+
 class ToxClassifierConfig(object):
     # pylint: disable = too-many-arguments
     def __init__(self,
@@ -102,30 +205,39 @@ class ToxClassifierConfig(object):
                  restore_path=LATEST_KERAS_WEIGHTS,
                  checkpoint=False,
                  checkpoint_path=RES_OUT_DIR,
-                 use_gpu=tf.test.is_gpu_available(),
-                 train_labels_1_ratio=data.Dataset.init_embedding_from_dump()[2],
+                 use_gpu=None,
+                 train_labels_1_ratio=None,
                  run_name='',
                  train_on_toxic_only=False,
+                 loss_scale=128.,
                  debug=True):
         self.restore = restore
         self.restore_path = restore_path
         self.checkpoint = checkpoint
         self.checkpoint_path = checkpoint_path
-        self.use_gpu = use_gpu
+        # resolved here and not as default args, those would run at import time
+        self.use_gpu = tf.test.is_gpu_available() if use_gpu is None else use_gpu
+        if train_labels_1_ratio is None:
+            train_labels_1_ratio = data.Dataset.init_embedding_from_dump()[2]
         self.train_labels_1_ratio = train_labels_1_ratio
         self.run_name = run_name
         self.train_on_toxic_only = train_on_toxic_only
+        # only applied when the session runs in mixed precision, see create_session
+        self.loss_scale = loss_scale
         self.debug = debug
 
 
 class ToxicityClassifier(object):
+    CLASSIFY_BATCH_SIZE = 32  # keras' default predict batch size
+
     # pylint: disable = too-many-arguments
     def __init__(self, session, max_seq=500, embedding_matrix=None, config=None):
         # type: (tf.Session, np.int, np.ndarray, ToxClassifierConfig) -> None
 
         if embedding_matrix is None:
             embedding_matrix = data.Dataset.init_embedding_from_dump()[0]
-        self._embedding = embedding_matrix
+        self._embedding_np = embedding_matrix
+        self._embedding_tensor = None
         self._num_tokens = embedding_matrix.shape[0]
         self._embed_dim = embedding_matrix.shape[1]
         self._input_layer = None
@@ -133,16 +245,22 @@ class ToxicityClassifier(object):
         self._atten_w = None
         self._metrics = ['accuracy', 'ce', calc_precision, calc_recall, calc_f1]
         self.grad_fn = None
+        self._attention_fn = None
+        self._batch_fns = dict()
         self._session = session
         self._max_seq = max_seq
         self._config = config if config else ToxClassifierConfig()
         self._model = self._build_graph()  # type: keras.Model
+        # tracing the model into a K.function is costly, build them once for the attack loops
+        self.grad_fn = self.get_grad_fn()
+        self._attention_fn = self.get_attention_fn()
 
     # LAYERS ------------------------------------------------------------------------
 
     def embedding_layer(self, tensor):
-        emb = layers.Embedding(input_dim=self._num_tokens, output_dim=self._embed_dim, input_length=self._max_seq,
-                               trainable=False, mask_zero=False, weights=[self._embedding])
+        # a plain int32 gather; kept as a layer so the saved weights still line up on restore
+        emb = layers.Embedding(input_dim=self._num_tokens, output_dim=self._embed_dim, trainable=False,
+                               weights=[self._embedding_np])
         return emb(tensor)
 
     def spatial_dropout_layer(self, tensor, rate=0.25):
@@ -153,44 +271,43 @@ class ToxicityClassifier(object):
         dropout = layers.Dropout(rate=rate)
         return dropout(tensor)
 
-    def bidirectional_rnn(self, tensor, amount=60):
+    def gru_layer(self, amount):
         if self._config.use_gpu:
-            bi_rnn = layers.Bidirectional(layers.CuDNNGRU(amount, return_sequences=True))
-        else:
-            bi_rnn = layers.Bidirectional(
-                layers.GRU(amount, return_sequences=True, reset_after=True, recurrent_activation='sigmoid'))
+            return layers.CuDNNGRU(amount, return_sequences=True)
+        # cuDNN-compatible math; keras converts CuDNNGRU weights on load so checkpoints work on cpu and gpu
+        # implementation=2 does one fused matmul for all three gates per step instead of three
+        return layers.GRU(amount, return_sequences=True, activation='tanh', recurrent_activation='sigmoid',
+                          use_bias=True, reset_after=True, dropout=0., recurrent_dropout=0., unroll=False,
+                          implementation=2)
+
+    def bidirectional_rnn(self, tensor, amount=60):
+        bi_rnn = layers.Bidirectional(self.gru_layer(amount))
         return bi_rnn(tensor)
 
     def concat_layer(self, tensors, axis):
         return layers.concatenate(tensors, axis=axis)
 
-    def mask_tensor(self, tensor):
-        zeros = K.zeros_like(tensor[:, :, 0], dtype=np.int32)
-        bool_mask = K.not_equal(zeros, self._input_layer)
-        bool_mask_float = tf.cast(bool_mask, np.float32)
-        bool_mask_float = K.tile(K.expand_dims(bool_mask_float), n=(1, 1, 240))
-        return tf.multiply(tensor, bool_mask_float)
+    @staticmethod
+    def mask_tensor(tensors):
+        # the token ids are a layer input (not self._input_layer) so the model can be applied to other inputs
+        tensor, input_ids = tensors
+        # (batch, seq, 1) mask broadcasts over the channels, no need to tile it
+        mask = K.cast(K.not_equal(input_ids, 0), K.dtype(tensor))
+        return tensor * K.expand_dims(mask)
 
     def mask_seq(self, tensor):
         mask = layers.Lambda(self.mask_tensor)
-        return mask(tensor)
+        return mask([tensor, self._input_layer])
 
     def last_stage(self, tensor):
         last = layers.Lambda(lambda t: t[:, -1], name='last')
         return last(tensor)
 
-    def max_polling_layer(self, tensor):
-        maxpool = layers.GlobalMaxPooling1D()
-        return maxpool(tensor)
-
-    def avg_polling_layer(self, tensor):
-        avgpool = layers.GlobalAveragePooling1D()
-        return avgpool(tensor)
-
-    def attention_layer(self, tensor):
-        attenion = AttentionWeightedAverage()
-        atten, atten_w = attenion(tensor)
-        return atten, atten_w
+    def attention_pooling_layer(self, tensor):
+        # attention, max pool and avg pool over the timesteps in one layer
+        attenion = AttentionWeightedAverage(return_pooling=True)
+        atten, maxpool, avgpool, atten_w = attenion(tensor)
+        return atten, maxpool, avgpool, atten_w
 
     def dense_layer(self, tensor, out_size=144):
         dense = layers.Dense(out_size, activation='relu')
@@ -207,8 +324,11 @@ class ToxicityClassifier(object):
 
         # embed:
         self._input_layer = keras.Input(shape=(self._max_seq,), dtype='int32')
-        self._embedding = self.embedding_layer(self._input_layer)
-        dropout1 = self.spatial_dropout_layer(self._embedding)
+        self._embedding_tensor = self.embedding_layer(self._input_layer)
+        # the values now live in the layer variable, the classifier no longer needs its reference
+        # (on the default path the matrix itself stays alive in the init_embedding_from_dump cache)
+        self._embedding_np = None
+        dropout1 = self.spatial_dropout_layer(self._embedding_tensor)
 
         # rnn:
         rnn1 = self.bidirectional_rnn(dropout1)
@@ -216,10 +336,8 @@ class ToxicityClassifier(object):
         concat = self.concat_layer([rnn1, rnn2], axis=2)
         mask = self.mask_seq(concat)
         # attentions:
-        avgpool = self.avg_polling_layer(mask)
-        maxpool = self.max_polling_layer(mask)
         last_stage = self.last_stage(mask)
-        atten, self._atten_w = self.attention_layer(mask)
+        atten, maxpool, avgpool, self._atten_w = self.attention_pooling_layer(mask)
         all_views = self.concat_layer([last_stage, maxpool, avgpool, atten], axis=1)
 
         # classify:
@@ -231,7 +349,12 @@ class ToxicityClassifier(object):
             self._output_layer = self.output_layer(dense)
 
         model = keras.Model(inputs=self._input_layer, outputs=self._output_layer)
-        adam_optimizer = keras.optimizers.Adam(lr=1e-3, decay=1e-6, clipvalue=5)
+        if uses_mixed_precision(self._session):
+            loss_scale = self._config.loss_scale
+            adam_optimizer = LossScaledAdam(loss_scale=loss_scale, lr=1e-3, decay=1e-6, clipvalue=5)
+        else:
+            loss_scale = 1.
+            adam_optimizer = keras.optimizers.Adam(lr=1e-3, decay=1e-6, clipvalue=5)
 
         # restore:
         if self._config.restore:
@@ -242,7 +365,8 @@ class ToxicityClassifier(object):
 
         model.compile(
             loss=CustomLoss.binary_crossentropy_with_bias(self._config.train_labels_1_ratio,
-                                                          self._config.train_on_toxic_only),
+                                                          self._config.train_on_toxic_only,
+                                                          loss_scale),
             optimizer=adam_optimizer,
             metrics=self._metrics)
 
@@ -269,38 +393,61 @@ class ToxicityClassifier(object):
         # type: (data.Dataset) -> keras.callbacks.History
         callback_list = self._define_callbacks()
         callback_list.append(RocCallback(dataset))
+        # the embedding input is int32, feeding int64 tokens would cost a cast and double the index bandwidth
+        train_seq = dataset.train_seq.astype(np.int32, copy=False)
+        val_seq = dataset.val_seq.astype(np.int32, copy=False)
         if self._config.train_on_toxic_only:
-            history = self._model.fit(x=dataset.train_seq[:, :], y=dataset.train_lbl[:, 0], batch_size=500,
-                                      validation_data=(dataset.val_seq[:, :], dataset.val_lbl[:, 0]), epochs=50,
-                                      callbacks=callback_list)
+            train_lbl, val_lbl = dataset.train_lbl[:, 0], dataset.val_lbl[:, 0]
         else:
-            history = self._model.fit(x=dataset.train_seq[:, :], y=dataset.train_lbl[:, :], batch_size=500,
-                                      validation_data=(dataset.val_seq[:, :], dataset.val_lbl[:, :]), epochs=50,
-                                      callbacks=callback_list)
+            train_lbl, val_lbl = dataset.train_lbl[:, :], dataset.val_lbl[:, :]
+        # batches are gathered on a background thread and queued while the previous step runs
+        train_batches = BatchSequence(train_seq, train_lbl, batch_size=500)
+        # a Sequence for validation too, otherwise keras evaluates with the size of the last training batch
+        val_batches = BatchSequence(val_seq, val_lbl, batch_size=500, shuffle=False)
+        history = self._model.fit_generator(train_batches, validation_data=val_batches, epochs=50,
+                                            callbacks=callback_list, max_queue_size=10, workers=1,
+                                            use_multiprocessing=False, shuffle=False)
         return history
 
     # INFER ------------------------------------------------------------------------
 
     def classify(self, seq):
         # type: (np.ndarray) -> np.ndarray
-        prediction = self._model.predict(seq)
+        batch_fn = self._batch_fns.get(len(seq))
+        if batch_fn is not None:
+            return batch_fn([seq])[0]
+        if len(seq) > self.CLASSIFY_BATCH_SIZE:
+            # large arrays (e.g. a whole val/test set) still go through predict's batching to bound memory
+            return self._model.predict(seq, batch_size=self.CLASSIFY_BATCH_SIZE)
+        # attacks call this on one or a few sequences at a time, skip predict's batching and callbacks overhead
+        prediction = self._model.predict_on_batch(seq)
         return prediction
 
+    def compile_for_batch(self, batch_size):
+        """
+        Builds (once per batch size) an inference function over a fixed batch shape, so every op in the graph
+        sees static shapes that XLA can specialize on. classify uses it for batches of that size.
+        """
+        if batch_size not in self._batch_fns:
+            input_layer = keras.Input(batch_shape=(batch_size, self._max_seq), dtype='int32')
+            self._batch_fns[batch_size] = K.function(inputs=[input_layer], outputs=[self._model(input_layer)])
+        return self._batch_fns[batch_size]
+
     def get_grad_fn(self):
-        # only interested in the first label
-        grad_0 = K.gradients(loss=self._model.output[:, 0], variables=self._embedding)[0]
-        grads = [grad_0]
-        fn = K.function(inputs=[self._model.input], outputs=grads)
-        return fn
+        if self.grad_fn is None:
+            # only interested in the first label
+            grad_0 = K.gradients(loss=self._model.output[:, 0], variables=self._embedding_tensor)[0]
+            grads = [grad_0]
+            self.grad_fn = K.function(inputs=[self._model.input], outputs=grads)
+        return self.grad_fn
 
     def get_gradient(self, seq):
-        self.grad_fn = self.get_grad_fn() if self.grad_fn == None else self.grad_fn
         return self.grad_fn([seq])[0]
 
     def get_attention(self, seq):
-        fn = K.function(inputs=[self._model.input], outputs=[self._atten_w])
-        return fn([seq])[0]
+        return self._attention_fn([seq])[0]
 
     def get_attention_fn(self):
-        fn = K.function(inputs=[self._model.input], outputs=[self._atten_w])
-        return fn
+        if self._attention_fn is None:
+            self._attention_fn = K.function(inputs=[self._model.input], outputs=[self._atten_w])
+        return self._attention_fn
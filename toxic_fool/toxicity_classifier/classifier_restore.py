@@ -2,13 +2,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import tensorflow as tf
-
-from toxicity_classifier.classifier import ToxicityClassifier
+from toxicity_classifier.classifier import ToxicityClassifier, create_session
 
 
 def restore():
-    sess = tf.Session()
+    sess = create_session()
     tox_model = ToxicityClassifier(session=sess)
     return tox_model
 
@@ -3,18 +3,17 @@ from __future__ import division
 from __future__ import print_function
 
 import numpy as np
-import tensorflow as tf
 
 import data
 
-from toxicity_classifier.classifier import ToxicityClassifier, ToxClassifierConfig
+from toxicity_classifier.classifier import ToxicityClassifier, create_session, ToxClassifierConfig
 from resources_out import RES_OUT_DIR
 from resources import LATEST_KERAS_WEIGHTS
 import argparse
 
 
-def train(config):
-    sess = tf.Session()
+def train(config, mixed_precision=False):
+    sess = create_session(mixed_precision=mixed_precision)
     embedding_matrix = data.Dataset.init_embedding_from_dump()
     max_seq = 400
     config.train_labels_1_ratio = embedding_matrix[2]
@@ -50,6 +49,8 @@ def main():
                         dest="run_name", help='Will be added to the saved checkpoint names')
     parser.add_argument('-toxic_only', action='store_true', default=False, dest='toxic_only',
                         help='Whether to train on toxic class only')
+    parser.add_argument('-mixed_precision', action='store_true', default=False, dest='mixed_precision',
+                        help='Whether to run the graph in mixed float16 precision (with static loss scaling)')
     args = parser.parse_args()
 
     config = ToxClassifierConfig(restore=args.restore,
@@ -60,7 +61,7 @@ def main():
                                  run_name=args.run_name,
                                  train_on_toxic_only=args.toxic_only)
 
-    train(config=config)
+    train(config=config, mixed_precision=args.mixed_precision)
 
 
 if __name__ == '__main__':